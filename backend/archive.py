@@ -0,0 +1,227 @@
+"""
+archive.py
+
+Clients for running ADQL queries against the Gaia archive.
+
+``TapArchiveClient`` talks TAP directly over one pooled, keep-alive HTTP
+session shared by all requests of a worker. Small queries go through the
+synchronous ``/sync`` endpoint; larger ones fall back to an ``/async`` job.
+Transient failures are retried with exponential backoff and jitter, and the
+response body is parsed as it streams in (VOTable or CSV).
+``AstroqueryArchiveClient`` keeps the previous ``astroquery.gaia`` behaviour.
+
+Both return an astropy Table. For offline load testing, point the client at
+the stand-in server in local_tap.py.
+
+Environment:
+- GAIAMAPS_ARCHIVE               # "tap" (default) or "astroquery"
+- GAIAMAPS_TAP_URL               # TAP service root (default: ESA Gaia archive)
+- GAIAMAPS_ARCHIVE_FORMAT        # "votable" (default) or "csv"
+- GAIAMAPS_ARCHIVE_TIMEOUT       # read timeout in seconds (default 60)
+- GAIAMAPS_ARCHIVE_RETRIES       # attempts after the first one (default 2)
+- GAIAMAPS_ARCHIVE_POOL_SIZE     # max pooled connections per host (default 10)
+"""
+import csv
+import os
+import random
+import sys
+import time
+from urllib.parse import urljoin
+
+import numpy as np
+
+from metrics import span
+
+GAIA_TAP_URL = "https://gea.esac.esa.int/tap-server/tap"
+# The Gaia archive truncates synchronous results beyond this many rows
+SYNC_ROW_LIMIT = 2000
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+class ArchiveError(Exception):
+    """The archive rejected the query (e.g. an ADQL error)."""
+
+
+class ArchiveUnavailable(ArchiveError):
+    """The archive could not be reached or kept failing after all retries."""
+
+
+# --- Response parsing ---
+CSV_NULLS = frozenset({'', 'null'})
+
+
+def _parse_csv_column(values):
+    """Narrowest of int64/float64/str that fits every non-null value, nulls masked."""
+    mask = [v in CSV_NULLS for v in values]
+    for cast, dtype in ((int, np.int64), (float, np.float64)):
+        try:
+            data = [0 if null else cast(v) for v, null in zip(values, mask)]
+        except ValueError:
+            continue
+        return np.ma.masked_array(data, mask=mask, dtype=dtype)
+    return np.ma.masked_array(values, mask=mask)
+
+
+def read_csv_stream(lines):
+    """Build an astropy Table from an iterable of CSV text lines (header first)."""
+    from astropy.table import MaskedColumn, Table
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return Table()
+    columns = [[] for _ in header]
+    for row in reader:
+        for column, value in zip(columns, row):
+            column.append(value)
+    return Table([MaskedColumn(_parse_csv_column(values), name=name)
+                  for name, values in zip(header, columns)])
+
+
+def read_votable_stream(source):
+    """
+    Parse a VOTable from a read callable or seekable file, raising ArchiveError
+    on QUERY_STATUS=ERROR.
+    """
+    from astropy.io.votable import parse
+    votable = parse(source)
+    for resource in votable.resources:
+        for info in resource.infos:
+            if info.name == 'QUERY_STATUS' and info.value == 'ERROR':
+                raise ArchiveError(info.content or "Query failed")
+    return votable.get_first_table().to_table(use_names_over_ids=True)
+
+
+# --- Clients ---
+class TapArchiveClient:
+    def __init__(self, base_url=GAIA_TAP_URL, fmt="votable", timeout=60.0, connect_timeout=10.0,
+                 retries=2, backoff=0.5, pool_size=10, async_timeout=300.0):
+        import requests
+        from requests.adapters import HTTPAdapter
+        self.base_url = base_url.rstrip('/')
+        self.fmt = fmt
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.async_timeout = async_timeout
+        self._requests = requests
+        self.session = requests.Session()
+        # Retries are handled in _request so every attempt gets jittered backoff
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _sleep_before_retry(self, attempt):
+        time.sleep(self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def _request(self, method, url, idempotent=True, **kwargs):
+        """
+        Send a request, retrying connection errors and retryable statuses.
+        Non-idempotent requests are only retried when the connection could not
+        be made, never once the request may have reached the server.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        retryable = (self._requests.ConnectionError, self._requests.Timeout) if idempotent \
+            else (self._requests.ConnectionError,)
+        for attempt in range(self.retries + 1):
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (self._requests.ConnectionError, self._requests.Timeout) as e:
+                if attempt == self.retries or not isinstance(e, retryable):
+                    raise ArchiveUnavailable(f"Archive unreachable: {e}") from e
+                print(f"[ARCHIVE] {method} {url} failed ({e}), retrying", file=sys.stderr)
+                self._sleep_before_retry(attempt)
+                continue
+            if resp.status_code in RETRY_STATUS and idempotent:
+                resp.close()
+                if attempt == self.retries:
+                    raise ArchiveUnavailable(f"Archive returned HTTP {resp.status_code}")
+                print(f"[ARCHIVE] {method} {url} returned {resp.status_code}, retrying", file=sys.stderr)
+                self._sleep_before_retry(attempt)
+                continue
+            return resp
+
+    def _read_results(self, resp):
+        with resp:
+            if resp.status_code >= 400:
+                raise ArchiveError(f"Archive returned HTTP {resp.status_code}: {resp.text[:200]}")
+            with span("votable_parse"):
+                if self.fmt == "csv":
+                    return read_csv_stream(resp.iter_lines(decode_unicode=True))
+                # Let urllib3 undo gzip so the parser can read the raw socket stream
+                resp.raw.decode_content = True
+                # Pass the read callable: astropy tries to seek() file objects,
+                # which a socket stream cannot do
+                return read_votable_stream(resp.raw.read)
+
+    def _query_params(self, adql):
+        return {"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": self.fmt, "QUERY": adql}
+
+    def _query_sync(self, adql):
+        with span("archive_job"):
+            resp = self._request("POST", f"{self.base_url}/sync", data=self._query_params(adql), stream=True)
+        return self._read_results(resp)
+
+    def _query_async(self, adql):
+        with span("archive_job"):
+            params = {**self._query_params(adql), "PHASE": "RUN"}
+            # Job creation is not idempotent: a retry could start a duplicate job
+            resp = self._request("POST", f"{self.base_url}/async", idempotent=False,
+                                 data=params, allow_redirects=False)
+            location = resp.headers.get("Location")
+            resp.close()
+            if resp.status_code in RETRY_STATUS:
+                raise ArchiveUnavailable(f"Archive returned HTTP {resp.status_code} creating an async job")
+            if not location:
+                raise ArchiveError(f"Archive did not create an async job (HTTP {resp.status_code})")
+            job_url = urljoin(resp.url, location).rstrip('/')
+            deadline = time.monotonic() + self.async_timeout
+            delay = 0.25
+            while True:
+                resp = self._request("GET", f"{job_url}/phase")
+                if resp.status_code >= 400:
+                    raise ArchiveError(f"Async job {job_url} phase check returned HTTP {resp.status_code}")
+                phase = resp.text.strip()
+                if phase == "COMPLETED":
+                    break
+                if phase in ("ERROR", "ABORTED"):
+                    raise ArchiveError(f"Async job {job_url} ended in phase {phase}")
+                if time.monotonic() > deadline:
+                    raise ArchiveUnavailable(f"Async job {job_url} did not finish in {self.async_timeout:.0f}s")
+                time.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            resp = self._request("GET", f"{job_url}/results/result", stream=True)
+        return self._read_results(resp)
+
+    def query(self, adql, max_rows=None):
+        """Run *adql* and return the result as an astropy Table."""
+        if max_rows is not None and max_rows > SYNC_ROW_LIMIT:
+            return self._query_async(adql)
+        return self._query_sync(adql)
+
+
+class AstroqueryArchiveClient:
+    """The module-global astroquery Gaia client."""
+
+    def query(self, adql, max_rows=None):
+        from astroquery.gaia import Gaia
+        # Synchronous jobs are fetched and parsed inside launch_job
+        with span("archive_job"):
+            if max_rows is not None and max_rows > SYNC_ROW_LIMIT:
+                job = Gaia.launch_job_async(adql)
+            else:
+                job = Gaia.launch_job(adql)
+        with span("votable_parse"):
+            return job.get_results()
+
+
+def make_archive_client():
+    """Build the archive client selected by the GAIAMAPS_ARCHIVE* environment variables."""
+    if os.environ.get("GAIAMAPS_ARCHIVE", "tap") == "astroquery":
+        return AstroqueryArchiveClient()
+    return TapArchiveClient(
+        base_url=os.environ.get("GAIAMAPS_TAP_URL", GAIA_TAP_URL),
+        fmt=os.environ.get("GAIAMAPS_ARCHIVE_FORMAT", "votable"),
+        timeout=float(os.environ.get("GAIAMAPS_ARCHIVE_TIMEOUT", "60")),
+        retries=int(os.environ.get("GAIAMAPS_ARCHIVE_RETRIES", "2")),
+        pool_size=int(os.environ.get("GAIAMAPS_ARCHIVE_POOL_SIZE", "10")),
+    )
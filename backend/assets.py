@@ -0,0 +1,108 @@
+"""
+assets.py
+
+Shared, pre-decoded assets for PDF generation.
+
+Background images are decoded once into raw RGBA ``.npy`` files in a cache
+directory and memory-mapped read-only, so every worker process shares the same
+pages instead of decoding its own JPEG copy. Font registrations are cached per
+process. Every entry is keyed by the source file's mtime and size, so
+replacing an asset on disk invalidates it.
+
+Environment:
+- GAIAMAPS_ASSET_CACHE_DIR   # where decoded images are kept (default: <tmp>/gaiamaps-assets)
+"""
+import glob
+import hashlib
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+from metrics import record_cache
+
+ASSET_CACHE_DIR = os.environ.get(
+    "GAIAMAPS_ASSET_CACHE_DIR", os.path.join(tempfile.gettempdir(), "gaiamaps-assets")
+)
+
+_lock = threading.Lock()
+_images = {}    # path -> (stamp, read-only RGBA array)
+_fonts = {}     # font name -> stamp
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _decoded_prefix(path):
+    # The full-path hash keeps same-named assets from different folders apart
+    stem = os.path.splitext(os.path.basename(path))[0]
+    digest = hashlib.sha1(os.path.abspath(path).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(ASSET_CACHE_DIR, f"{stem}-{digest}")
+
+
+def _decoded_path(path, stamp):
+    return f"{_decoded_prefix(path)}-{stamp[0]}-{stamp[1]}.npy"
+
+
+def _decode_to_disk(path, target):
+    from PIL import Image
+    os.makedirs(ASSET_CACHE_DIR, exist_ok=True)
+    with Image.open(path) as img:
+        rgba = np.asarray(img.convert("RGBA"))
+    # Write to a temp file and rename, so concurrent workers never map a partial file
+    fd, tmp = tempfile.mkstemp(dir=ASSET_CACHE_DIR, suffix=".npy.tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, rgba)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    # Drop decodes of older versions of the same file
+    for stale in glob.glob(f"{glob.escape(_decoded_prefix(path))}-*.npy"):
+        if stale != target:
+            try:
+                os.unlink(stale)
+            except OSError:
+                pass
+
+
+def load_image(path):
+    """
+    Return *path* as a read-only uint8 RGBA array of shape (H, W, 4).
+
+    The array is memory-mapped from the decoded cache file; copy it before
+    modifying.
+    """
+    stamp = _stamp(path)
+    with _lock:
+        cached = _images.get(path)
+        if cached is not None and cached[0] == stamp:
+            record_cache("assets", True)
+            return cached[1]
+        record_cache("assets", False)
+        target = _decoded_path(path, stamp)
+        if not os.path.exists(target):
+            _decode_to_disk(path, target)
+        rgba = np.load(target, mmap_mode="r")
+        _images[path] = (stamp, rgba)
+        return rgba
+
+
+def register_fonts(fonts):
+    """
+    Register TrueType fonts given as {name: path} with ReportLab, parsing
+    each file only when it is new or has changed on disk.
+    """
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    with _lock:
+        for name, path in fonts.items():
+            stamp = _stamp(path)
+            if _fonts.get(name) == stamp:
+                continue
+            pdfmetrics.registerFont(TTFont(name, path))
+            _fonts[name] = stamp
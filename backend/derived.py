@@ -0,0 +1,143 @@
+"""
+derived.py
+
+Vectorised derived quantities for many Gaia stars at once.
+
+Takes arrays of ra/dec/parallax/G/bp_rp (e.g. a whole /get-stars result) and
+computes distance, absolute magnitude, spectral class and galactocentric x/y
+in one numpy pass. The ICRS -> Galactocentric transform is affine, so it is
+evaluated with astropy once per process and then applied as a plain matrix.
+"""
+from functools import lru_cache
+
+import numpy as np
+
+PC_TO_LY = 3.26156
+# Same frame parameters as the Milky Way overlay
+GALCEN_DISTANCE_KPC = 8.0
+Z_SUN_PC = 0.0
+
+SPECTRAL_CLASSES = np.array(['O', 'B', 'A', 'F', 'G', 'K', 'M'])
+# Upper BP-RP edge of each class except M (see generate_pdf.classify_spectral_type)
+_CLASS_EDGES = np.array([-0.3, 0.0, 0.3, 0.7, 1.1, 1.8])
+# (lo, hi) color range used for the subclass digit of each class
+_CLASS_LO = np.array([-1.0, -0.3, 0.0, 0.3, 0.7, 1.1, 1.8])
+_CLASS_HI = np.array([-0.3, 0.0, 0.3, 0.7, 1.1, 1.8, 3.0])
+
+
+def _as_float_array(values):
+    """Convert a list/column (possibly masked or containing None) to a float array with NaN gaps."""
+    if np.ma.isMaskedArray(values):
+        return np.ma.filled(values.astype(float), np.nan)
+    arr = np.asarray(values)
+    if arr.dtype == object:
+        arr = np.array([np.nan if v is None else v for v in arr.ravel()], dtype=float).reshape(arr.shape)
+    return arr.astype(float)
+
+
+def distance_pc(parallax_mas):
+    """Distance in parsecs from parallax in mas; NaN where the parallax is missing or non-positive."""
+    p = _as_float_array(parallax_mas)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(p > 0, 1000.0 / p, np.nan)
+
+
+def absolute_magnitude(phot_g_mean_mag, parallax_mas):
+    """Absolute G magnitude, M_G = G + 5 log10(parallax_mas) - 10."""
+    g = _as_float_array(phot_g_mean_mag)
+    p = _as_float_array(parallax_mas)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(p > 0, g + 5 * np.log10(p) - 10, np.nan)
+
+
+def classify_spectral_types(color_index, abs_mag):
+    """
+    Vectorised ``classify_spectral_type``: same class boundaries, subclass
+    digit and luminosity class, element-wise. Entries without a color index
+    are returned as None.
+    """
+    color = _as_float_array(color_index)
+    mag = _as_float_array(abs_mag)
+    color, mag = np.broadcast_arrays(color, mag)
+    cls = np.searchsorted(_CLASS_EDGES, color, side='right')
+    lo = _CLASS_LO[cls]
+    hi = _CLASS_HI[cls]
+    with np.errstate(invalid='ignore'):
+        frac = (color - lo) / (hi - lo)
+        digit = np.clip(np.trunc(frac * 10), 0, 9)
+    # NaN > 2 is False, matching the scalar classifier's 'III' fallback
+    lum = np.where(mag > 2, 'V', 'III')
+    result = np.empty(color.shape, dtype=object)
+    valid = ~np.isnan(color)
+    for idx in np.ndindex(color.shape):
+        if valid[idx]:
+            result[idx] = f"{SPECTRAL_CLASSES[cls[idx]]}{int(digit[idx])} {lum[idx]}"
+    return result
+
+
+@lru_cache(maxsize=None)
+def _icrs_to_galcen():
+    """Return (matrix, offset) in kpc such that galcen = matrix @ icrs_xyz + offset."""
+    from astropy import units as u
+    from astropy.coordinates import CartesianRepresentation, Galactocentric, SkyCoord
+    basis = np.hstack([np.eye(3), -np.eye(3)])  # +x, +y, +z, -x, -y, -z at 1 kpc
+    icrs = SkyCoord(CartesianRepresentation(basis * u.kpc), frame='icrs')
+    galcen = icrs.transform_to(Galactocentric(galcen_distance=GALCEN_DISTANCE_KPC * u.kpc, z_sun=Z_SUN_PC * u.pc))
+    xyz = galcen.cartesian.xyz.to_value(u.kpc)
+    plus, minus = xyz[:, :3], xyz[:, 3:]
+    offset = (plus + minus).mean(axis=1) / 2
+    matrix = (plus - minus) / 2
+    return matrix, offset
+
+
+def galactocentric_xyz(ra_deg, dec_deg, dist_pc):
+    """Galactocentric cartesian coordinates in kpc, shape (3, N)."""
+    ra = np.deg2rad(_as_float_array(ra_deg))
+    dec = np.deg2rad(_as_float_array(dec_deg))
+    d_kpc = _as_float_array(dist_pc) / 1000.0
+    icrs = np.stack([
+        d_kpc * np.cos(dec) * np.cos(ra),
+        d_kpc * np.cos(dec) * np.sin(ra),
+        d_kpc * np.sin(dec),
+    ])
+    matrix, offset = _icrs_to_galcen()
+    return np.tensordot(matrix, icrs, axes=1) + offset.reshape((3,) + (1,) * (icrs.ndim - 1))
+
+
+def derive(ra, dec, parallax, phot_g_mean_mag, bp_rp):
+    """
+    Compute every derived quantity for arrays of stars in one pass.
+
+    Returns a dict of arrays keyed like the star fields used by the PDF:
+    distance_pc, distance_ly, abs_mag, spectral_type, galcen_x_kpc, galcen_y_kpc.
+    """
+    dist = distance_pc(parallax)
+    abs_mag = absolute_magnitude(phot_g_mean_mag, parallax)
+    xyz = galactocentric_xyz(ra, dec, dist)
+    return {
+        'distance_pc': dist,
+        'distance_ly': dist * PC_TO_LY,
+        'abs_mag': abs_mag,
+        'spectral_type': classify_spectral_types(bp_rp, abs_mag),
+        'galcen_x_kpc': xyz[0],
+        'galcen_y_kpc': xyz[1],
+    }
+
+
+def _json_value(value):
+    """numpy scalar -> plain Python value, with NaN mapped to None."""
+    if value is None:
+        return None
+    if isinstance(value, (float, np.floating)):
+        return None if np.isnan(value) else float(value)
+    return value
+
+
+def derived_rows(derived):
+    """Split the column dict returned by ``derive`` into one JSON-safe dict per star."""
+    keys = list(derived)
+    columns = [derived[k] for k in keys]
+    return [
+        {k: _json_value(col[i]) for k, col in zip(keys, columns)}
+        for i in range(len(columns[0]))
+    ]
@@ -0,0 +1,157 @@
+"""
+enrichment.py
+
+Per-source_id cache of the derived fields printed on a star certificate.
+
+Records are filled when /get-stars returns a star and read back by /star-pdf,
+so repeat certificates for the same star skip all astrophysical computation
+and rely on server-side values rather than the client payload.
+
+The cache is a bounded in-memory LRU, optionally backed by a small SQLite
+key-value file shared by all workers.
+
+Environment:
+- GAIAMAPS_ENRICHMENT_CACHE_SIZE   # max records kept in memory (default 10000)
+- GAIAMAPS_ENRICHMENT_DB           # path of the on-disk store (unset = memory only)
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from derived import derive, derived_rows
+from metrics import record_cache
+
+# Gaia columns copied verbatim into a record
+SOURCE_FIELDS = ('ra', 'dec', 'parallax', 'phot_g_mean_mag', 'bp_rp', 'pmra', 'pmdec')
+
+
+def source_key(star):
+    """Cache key for a star: its Gaia source id as a string, or None if unknown."""
+    value = star.get('source_id')
+    if value is None:
+        value = star.get('SOURCE_ID')
+    if value is None or value == '':
+        return None
+    return str(value)
+
+
+def _number(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if np.isnan(value) else value
+
+
+def build_record(star):
+    """
+    Build the certificate fields for a star that already carries the derived
+    quantities from ``derived.derive`` (distance_ly, abs_mag, ...).
+    """
+    record = {k: _number(star.get(k)) for k in SOURCE_FIELDS}
+    record['color_index'] = record['bp_rp']
+    distance_ly = _number(star.get('distance_ly'))
+    if distance_ly is not None:
+        record['distance_ly'] = round(distance_ly)
+    abs_mag = _number(star.get('abs_mag'))
+    if abs_mag is not None:
+        record['abs_mag'] = round(abs_mag, 2)
+    if star.get('spectral_type') is not None:
+        record['spectral_type'] = star['spectral_type']
+    pmra, pmdec = record['pmra'], record['pmdec']
+    if pmra is not None and pmdec is not None:
+        pm_total = (pmra**2 + pmdec**2) ** 0.5
+        record['proper_motion'] = f"{pm_total:.1f} mas/yr"
+    galcen_x = _number(star.get('galcen_x_kpc'))
+    galcen_y = _number(star.get('galcen_y_kpc'))
+    if galcen_x is not None and galcen_y is not None:
+        record['galcen_x_kpc'] = galcen_x
+        record['galcen_y_kpc'] = galcen_y
+    # Drop missing values so they never override client-supplied fields
+    return {k: v for k, v in record.items() if v is not None}
+
+
+def compute_record(star):
+    """Run the derived-quantities pass for a single star and build its record."""
+    derived = derive([_number(star.get('ra'))], [_number(star.get('dec'))], [_number(star.get('parallax'))],
+                     [_number(star.get('phot_g_mean_mag'))], [_number(star.get('bp_rp'))])
+    return build_record({**star, **derived_rows(derived)[0]})
+
+
+# --- Cache ---
+class EnrichmentCache:
+    def __init__(self, maxsize=10000, db_path=None):
+        self.maxsize = maxsize
+        self._records = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=5)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute("CREATE TABLE IF NOT EXISTS enrichment (source_id TEXT PRIMARY KEY, record TEXT NOT NULL)")
+                self._db.commit()
+            except sqlite3.Error as e:
+                print(f"[ERROR] Could not open enrichment store {db_path}: {e}", file=sys.stderr)
+                self._db = None
+
+    def _remember(self, key, record):
+        # Caller holds the lock
+        self._records[key] = record
+        self._records.move_to_end(key)
+        while len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached record for *key*, or None."""
+        if key is None:
+            record_cache("enrichment", False)
+            return None
+        with self._lock:
+            record = self._records.get(key)
+            if record is not None:
+                self._records.move_to_end(key)
+            elif self._db is not None:
+                try:
+                    row = self._db.execute("SELECT record FROM enrichment WHERE source_id = ?", (key,)).fetchone()
+                except sqlite3.Error as e:
+                    print(f"[ERROR] Enrichment store read failed: {e}", file=sys.stderr)
+                    row = None
+                if row is not None:
+                    record = json.loads(row[0])
+                    self._remember(key, record)
+        record_cache("enrichment", record is not None)
+        return record
+
+    def put_many(self, items):
+        """Store (key, record) pairs, skipping entries without a key."""
+        items = [(key, record) for key, record in items if key is not None]
+        if not items:
+            return
+        with self._lock:
+            for key, record in items:
+                self._remember(key, record)
+            if self._db is not None:
+                try:
+                    self._db.executemany(
+                        "INSERT OR REPLACE INTO enrichment (source_id, record) VALUES (?, ?)",
+                        [(key, json.dumps(record)) for key, record in items],
+                    )
+                    self._db.commit()
+                except sqlite3.Error as e:
+                    print(f"[ERROR] Enrichment store write failed: {e}", file=sys.stderr)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+
+enrichment_cache = EnrichmentCache(
+    maxsize=int(os.environ.get("GAIAMAPS_ENRICHMENT_CACHE_SIZE", "10000")),
+    db_path=os.environ.get("GAIAMAPS_ENRICHMENT_DB"),
+)
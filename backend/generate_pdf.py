@@ -27,18 +27,22 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 # Add for Milky Way overlay
-from astropy import units as u
-from astropy.coordinates import SkyCoord, Galactocentric
+from derived import absolute_magnitude, distance_pc, galactocentric_xyz
+from metrics import span
+from assets import load_image, register_fonts
+import io
 
 # --- Add at the top, after imports ---
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.pdfbase import pdfmetrics
+from reportlab.lib.utils import ImageReader
 import os
 FONT_DIR = os.path.join(os.path.dirname(__file__), "fonts")
-pdfmetrics.registerFont(TTFont("Montserrat", os.path.join(FONT_DIR, "Montserrat-VariableFont_wght.ttf")))
-pdfmetrics.registerFont(TTFont("Montserrat-Italic", os.path.join(FONT_DIR, "Montserrat-Italic-VariableFont_wght.ttf")))
-pdfmetrics.registerFont(TTFont("OpenSans", os.path.join(FONT_DIR, "OpenSans-VariableFont_wdth,wght.ttf")))
-pdfmetrics.registerFont(TTFont("OpenSans-Italic", os.path.join(FONT_DIR, "OpenSans-Italic-VariableFont_wdth,wght.ttf")))
+FONTS = {
+    "Montserrat": os.path.join(FONT_DIR, "Montserrat-VariableFont_wght.ttf"),
+    "Montserrat-Italic": os.path.join(FONT_DIR, "Montserrat-Italic-VariableFont_wght.ttf"),
+    "OpenSans": os.path.join(FONT_DIR, "OpenSans-VariableFont_wdth,wght.ttf"),
+    "OpenSans-Italic": os.path.join(FONT_DIR, "OpenSans-Italic-VariableFont_wdth,wght.ttf"),
+}
+register_fonts(FONTS)
 
 # --- Set background to pure black ---
 COLORS = {
@@ -71,6 +75,13 @@ PAGE_WIDTH, PAGE_HEIGHT = A4
 MILKY_WAY_PATH = os.path.join(os.path.dirname(__file__), 'milky_way.jpeg')
 HR_DIAGRAM_PATH = os.path.join(os.path.dirname(__file__), 'hr_diagram.jpeg')
 
+# Decode backgrounds at startup so requests only map the shared buffers
+try:
+    load_image(MILKY_WAY_PATH)
+    load_image(HR_DIAGRAM_PATH)
+except Exception as e:
+    print(f"[ERROR] Could not pre-decode background images: {e}")
+
 # ---------- Spectral Type Classifier ----------
 def classify_spectral_type(color_index, abs_mag):
     """
@@ -139,29 +150,21 @@ star_info['spectral_type'] = classify_spectral_type(
 )
 
 
-def draw_centered_image_auto_resized(c, img_path, x_center, y_center, draw_width, draw_height):
-    """Draw an image centered at (x, y), scaled to the given draw_width x draw_height exactly."""
-    if not os.path.exists(img_path):
-        raise FileNotFoundError(f"Image file not found: {img_path}")
-    try:
-        from PIL import Image
-        img = Image.open(img_path)
-        img_width, img_height = img.size
-    except Exception as e:
-        raise RuntimeError(f"Could not open image {img_path}: {e}")
+def draw_centered_image_auto_resized(c, img, x_center, y_center, draw_width, draw_height):
+    """Draw an image (path or ImageReader) centered at (x, y), scaled to the given draw_width x draw_height exactly."""
     x = x_center - draw_width / 2
     y = y_center - draw_height / 2
-    c.drawImage(img_path, x, y, draw_width, draw_height, preserveAspectRatio=False, anchor='c')
+    c.drawImage(img, x, y, draw_width, draw_height, preserveAspectRatio=False, anchor='c')
 
 
-def generate_hr_diagram_overlay(bp_rp, m_app, p_mas, hr_diagram_path=HR_DIAGRAM_PATH, output_path='hr_diagram_overlay.png'):
+def generate_hr_diagram_overlay(bp_rp, m_app, p_mas, hr_diagram_path=HR_DIAGRAM_PATH, output_path='hr_diagram_overlay.png', abs_mag=None):
     """
     Overplot the star on the HR diagram and save as a new image.
     Use a colorful inverted colormap for the background.
+    Pass the precomputed *abs_mag* to skip deriving it from m_app and p_mas.
     """
     import matplotlib.pyplot as plt
-    import numpy as np
-    img = plt.imread(hr_diagram_path)
+    img = load_image(hr_diagram_path)
     fig = plt.figure(figsize=(8, 12))
     ax_full = fig.add_axes((0, 0, 1, 1))
     ax_full.imshow(img[..., :3], origin='upper', cmap='inferno')
@@ -177,32 +180,29 @@ def generate_hr_diagram_overlay(bp_rp, m_app, p_mas, hr_diagram_path=HR_DIAGRAM_
     ax.set_xlim(x_min, x_max)
     ax.set_ylim(y_min, y_max)
     ax.invert_yaxis()
-    if p_mas > 0:
-        M_G = m_app - 10 + 5 * np.log10(p_mas)
-    else:
-        M_G = np.nan
+    M_G = float(abs_mag) if abs_mag is not None else float(absolute_magnitude(m_app, p_mas))
     # --- Use same marker style as MW overlay ---
     ax.scatter(bp_rp, M_G, s=900, marker='*', facecolor='yellow', edgecolor='black', linewidth=2.5, zorder=10)
     plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-    plt.savefig(output_path, bbox_inches='tight', pad_inches=0, dpi=150, transparent=True)
+    plt.savefig(output_path, format='png', bbox_inches='tight', pad_inches=0, dpi=150, transparent=True)
     plt.close(fig)
     return output_path
 
 
-def generate_mw_overlay(alpha_deg, delta_deg, parallax_mas, mw_path=MILKY_WAY_PATH, output_path='milky_way_overlay.png'):
+def generate_mw_overlay(alpha_deg, delta_deg, parallax_mas, mw_path=MILKY_WAY_PATH, output_path='milky_way_overlay.png', galcen_xy=None):
+    """
+    Overplot the star on the top-down Milky Way map and save as a new image.
+    Pass precomputed galactocentric (x, y) in kpc as *galcen_xy* to skip the transform.
+    """
     import matplotlib.pyplot as plt
     import numpy as np
-    from astropy import units as u
-    from astropy.coordinates import SkyCoord, Galactocentric
-    img = plt.imread(mw_path)
+    img = load_image(mw_path)
     fig_width = 8
     mw_aspect = img.shape[0] / img.shape[1]
     fig_height = fig_width * mw_aspect
     fig, ax = plt.subplots(figsize=(fig_width, fig_height))
-    if img.shape[-1] == 3:
-        alpha = np.ones(img.shape[:2])
-    else:
-        alpha = img[..., 3]
+    # Fresh float copy: the decoded image is a shared read-only buffer
+    alpha = img[..., 3] / 255.0
     mask = np.all(img[..., :3] < 0.1, axis=-1)
     alpha[mask] = 0.0
     ax.imshow(img[..., :3], extent=(-20, 20, -20, 20), origin='lower', aspect='auto', zorder=0, alpha=alpha)
@@ -210,18 +210,13 @@ def generate_mw_overlay(alpha_deg, delta_deg, parallax_mas, mw_path=MILKY_WAY_PA
     ax.set_ylim(-20, 20)
     ax.axis('off')
     try:
-        d_pc = 1000.0 / parallax_mas if parallax_mas > 0 else 1e6
-        d = d_pc * u.pc
-        c_icrs = SkyCoord(ra=alpha_deg * u.deg,
-                          dec=delta_deg * u.deg,
-                          distance=d,
-                          frame='icrs')
-        c_galcen = c_icrs.transform_to(Galactocentric(galcen_distance=8*u.kpc, z_sun=0*u.pc))
-        star_x_to = getattr(c_galcen.y, 'to', None)
-        star_y_to = getattr(c_galcen.x, 'to', None)
-        if star_x_to is not None and star_y_to is not None:
-            star_x = c_galcen.y.to(u.kpc).value  # type: ignore
-            star_y = c_galcen.x.to(u.kpc).value  # type: ignore
+        if galcen_xy is None:
+            galcen = galactocentric_xyz(alpha_deg, delta_deg, distance_pc(parallax_mas))
+            galcen_xy = (float(galcen[0]), float(galcen[1]))
+        # Map axes: horizontal is galactocentric y, vertical is galactocentric x
+        star_x = galcen_xy[1]
+        star_y = galcen_xy[0]
+        if np.isfinite(star_x) and np.isfinite(star_y):
             print(f"[MW Overlay] parallax: {parallax_mas} mas, galactocentric x: {star_x:.3f} kpc, y: {star_y:.3f} kpc")
             # --- Use same marker style as HR overlay ---
             ax.scatter(star_x, star_y, s=900, marker='*', facecolor='yellow', edgecolor='black', linewidth=2.5, zorder=20)
@@ -230,7 +225,7 @@ def generate_mw_overlay(alpha_deg, delta_deg, parallax_mas, mw_path=MILKY_WAY_PA
     except Exception as e:
         print(f"[ERROR] Could not transform coordinates: {e}")
     plt.subplots_adjust(left=0, right=1, top=1, bottom=0)
-    plt.savefig(output_path, bbox_inches='tight', pad_inches=0, dpi=150, transparent=True)
+    plt.savefig(output_path, format='png', bbox_inches='tight', pad_inches=0, dpi=150, transparent=True)
     plt.close(fig)
     return output_path
 
@@ -296,7 +291,8 @@ def draw_info_grid(c, x, y, col_w, row_h, entries):
 
 # --- Main PDF generation (replace body of generate_pdf) ---
 def generate_pdf(info, output_path='your_star.pdf'):
-    from PIL import Image
+    # Cheap mtime check; re-parses a font only if it changed on disk
+    register_fonts(FONTS)
     from reportlab.pdfgen import canvas
     from reportlab.lib.pagesizes import A4
     # Map ra_deg, dec_deg, parallax_mas from ra, dec, parallax if present
@@ -371,25 +367,37 @@ def generate_pdf(info, output_path='your_star.pdf'):
     available_height = image_top - image_bottom
     images_width = PAGE_WIDTH - 2 * MARGIN_X
     single_img_width = (images_width - SPACING) / 2
-    mw_overlay_path = generate_mw_overlay(
-        info.get('ra_deg', 0.0),
-        info.get('dec_deg', 0.0),
-        info.get('parallax_mas', 10.0),
-        mw_path=MILKY_WAY_PATH,
-        output_path='milky_way_overlay.png'
-    )
-    mw_img = Image.open(mw_overlay_path)
-    mw_w, mw_h = mw_img.size
+    # Galactocentric position precomputed by the derived-quantities pass, if present
+    galcen_xy = None
+    if info.get('galcen_x_kpc') is not None and info.get('galcen_y_kpc') is not None:
+        galcen_xy = (info['galcen_x_kpc'], info['galcen_y_kpc'])
+    # Overlays are rendered to memory and handed to ReportLab without touching disk
+    with span("mw_overlay"):
+        mw_overlay = generate_mw_overlay(
+            info.get('ra_deg', 0.0),
+            info.get('dec_deg', 0.0),
+            info.get('parallax_mas', 10.0),
+            mw_path=MILKY_WAY_PATH,
+            output_path=io.BytesIO(),
+            galcen_xy=galcen_xy
+        )
+    mw_overlay.seek(0)
+    mw_img = ImageReader(mw_overlay)
+    mw_w, mw_h = mw_img.getSize()
     mw_aspect = mw_h / mw_w
-    overlay_path = generate_hr_diagram_overlay(
-        info.get('color_index', 1.0),
-        info.get('m_app', 10.0),
-        info.get('parallax_mas', 10.0),
-        hr_diagram_path=HR_DIAGRAM_PATH,
-        output_path='hr_diagram_overlay.png'
-    )
-    hr_img = Image.open(overlay_path)
-    hr_w, hr_h = hr_img.size
+    with span("hr_overlay"):
+        # Same absolute magnitude as the info card; G only if it was not derived
+        hr_overlay = generate_hr_diagram_overlay(
+            info.get('color_index', 1.0),
+            info.get('phot_g_mean_mag', info.get('m_app', 10.0)),
+            info.get('parallax_mas', 10.0),
+            hr_diagram_path=HR_DIAGRAM_PATH,
+            output_path=io.BytesIO(),
+            abs_mag=info.get('abs_mag')
+        )
+    hr_overlay.seek(0)
+    hr_img = ImageReader(hr_overlay)
+    hr_w, hr_h = hr_img.getSize()
     hr_aspect = hr_h / hr_w
     max_img_height = available_height
     mw_draw_w = single_img_width
@@ -404,8 +412,8 @@ def generate_pdf(info, output_path='your_star.pdf'):
     left_x = MARGIN_X + mw_draw_w / 2
     right_x = MARGIN_X + single_img_width + SPACING + hr_draw_w / 2
     images_y = image_bottom + max_img_height / 2
-    draw_centered_image_auto_resized(c, mw_overlay_path, left_x, images_y, mw_draw_w, mw_draw_h)
-    draw_centered_image_auto_resized(c, overlay_path, right_x, images_y, hr_draw_w, hr_draw_h)
+    draw_centered_image_auto_resized(c, mw_img, left_x, images_y, mw_draw_w, mw_draw_h)
+    draw_centered_image_auto_resized(c, hr_img, right_x, images_y, hr_draw_w, hr_draw_h)
     # --- Bottom text ---
     c.setFont("OpenSans", 12)
     c.setFillColor(COLORS["secondary"])
@@ -438,8 +446,10 @@ def generate_pdf(info, output_path='your_star.pdf'):
         y = random.uniform(0, PAGE_HEIGHT)
         r = random.uniform(0.3, 1.1)
         c.circle(x, y, r, fill=1, stroke=0)
-    c.showPage()
-    c.save()
+    # Image embedding and font subsetting happen when the page is written out
+    with span("reportlab_save"):
+        c.showPage()
+        c.save()
     print(f"PDF generated: {output_path}")
 
 
@@ -0,0 +1,243 @@
+"""
+local_tap.py
+
+Local stand-in for the Gaia TAP service, for offline development and load
+testing of the /get-stars query path.
+
+Serves ``/tap/sync`` and a minimal ``/tap/async`` from the synthetic stars in
+fixtures/gaia_stars.csv, in VOTable or CSV. It understands the ADQL shape
+built by main.get_stars (TOP, CONTAINS/CIRCLE, phot_g_mean_mag cut,
+IS NOT NULL checks, DISTANCE ordering). The fixture field is laid out around
+(ra, dec) = (0, 0) and rotated onto each query's circle centre, so every
+location on Earth gets stars.
+
+Usage:
+    python local_tap.py --port 8001
+    GAIAMAPS_TAP_URL=http://localhost:8001/tap uvicorn main:app
+"""
+import argparse
+import csv
+import itertools
+import math
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+FIXTURE_PATH = os.path.join(os.path.dirname(__file__), 'fixtures', 'gaia_stars.csv')
+FIELD_TYPES = {'SOURCE_ID': 'long'}  # everything else is double
+
+_NUM = r'([-+]?[\d.]+(?:[eE][-+]?\d+)?)'
+TOP_RE = re.compile(r'\bTOP\s+(\d+)', re.I)
+CIRCLE_RE = re.compile(rf"CIRCLE\(\s*'ICRS'\s*,\s*{_NUM}\s*,\s*{_NUM}\s*,\s*{_NUM}\s*\)", re.I)
+POINT_RE = re.compile(rf"POINT\(\s*'ICRS'\s*,\s*{_NUM}\s*,\s*{_NUM}\s*\)", re.I)
+GMAG_RE = re.compile(rf'phot_g_mean_mag\s*<\s*{_NUM}', re.I)
+NOT_NULL_RE = re.compile(r'(\w+)\s+IS\s+NOT\s+NULL', re.I)
+
+
+class QueryError(Exception):
+    pass
+
+
+def load_fixture(path=FIXTURE_PATH):
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        rows = []
+        for row in reader:
+            rows.append({k: (None if v == '' else int(v) if FIELD_TYPES.get(k) == 'long' else float(v))
+                         for k, v in row.items()})
+    return reader.fieldnames, rows
+
+
+def _unit_vector(ra_deg, dec_deg):
+    ra, dec = math.radians(ra_deg), math.radians(dec_deg)
+    return (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec))
+
+
+def _recenter(ra_deg, dec_deg, center_ra, center_dec):
+    """Rotate a position so that (0, 0) lands on (center_ra, center_dec)."""
+    x, y, z = _unit_vector(ra_deg, dec_deg)
+    cd, sd = math.cos(math.radians(center_dec)), math.sin(math.radians(center_dec))
+    cr, sr = math.cos(math.radians(center_ra)), math.sin(math.radians(center_ra))
+    x1, z1 = x * cd - z * sd, x * sd + z * cd
+    x2, y2 = x1 * cr - y * sr, x1 * sr + y * cr
+    return math.degrees(math.atan2(y2, x2)) % 360.0, math.degrees(math.asin(max(-1.0, min(1.0, z1))))
+
+
+def _separation(ra1, dec1, ra2, dec2):
+    a, b = _unit_vector(ra1, dec1), _unit_vector(ra2, dec2)
+    dot = sum(p * q for p, q in zip(a, b))
+    return math.degrees(math.acos(max(-1.0, min(1.0, dot))))
+
+
+def run_query(adql, fields, rows, recenter=True):
+    """Evaluate the subset of ADQL used by /get-stars against the fixture rows."""
+    if 'gaia_source' not in adql:
+        raise QueryError("Only gaiadr3.gaia_source is available in the local stand-in")
+    circle = CIRCLE_RE.search(adql)
+    point = None
+    for match in POINT_RE.finditer(adql):
+        point = (float(match.group(1)), float(match.group(2)))
+    top = TOP_RE.search(adql)
+    gmag = GMAG_RE.search(adql)
+    not_null = [name for name in NOT_NULL_RE.findall(adql) if name in fields]
+    center = (float(circle.group(1)), float(circle.group(2))) if circle else point
+
+    result = []
+    for row in rows:
+        row = dict(row)
+        if recenter and center is not None:
+            row['ra'], row['dec'] = _recenter(row['ra'], row['dec'], *center)
+        if circle and _separation(row['ra'], row['dec'], center[0], center[1]) > float(circle.group(3)):
+            continue
+        if gmag and (row['phot_g_mean_mag'] is None or row['phot_g_mean_mag'] >= float(gmag.group(1))):
+            continue
+        if any(row[name] is None for name in not_null):
+            continue
+        if point is not None:
+            row['ang_dist'] = _separation(row['ra'], row['dec'], *point)
+        result.append(row)
+
+    out_fields = list(fields)
+    if point is not None:
+        out_fields.append('ang_dist')
+        result.sort(key=lambda r: r['ang_dist'])
+    if top:
+        result = result[:int(top.group(1))]
+    return out_fields, result
+
+
+def _format_value(value):
+    if value is None:
+        return ''
+    return repr(value)
+
+
+def to_csv(fields, rows):
+    lines = [','.join(fields)]
+    lines += [','.join(_format_value(row[k]) for k in fields) for row in rows]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def to_votable(fields, rows):
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>\n',
+        '<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n',
+        '<RESOURCE type="results">\n<INFO name="QUERY_STATUS" value="OK"/>\n<TABLE>\n',
+    ]
+    for name in fields:
+        parts.append(f'<FIELD name="{name}" datatype="{FIELD_TYPES.get(name, "double")}"/>\n')
+    parts.append('<DATA><TABLEDATA>\n')
+    for row in rows:
+        parts.append('<TR>' + ''.join(f'<TD>{_format_value(row[k])}</TD>' for k in fields) + '</TR>\n')
+    parts.append('</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n')
+    return ''.join(parts).encode('utf-8')
+
+
+def votable_error(message):
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+        f'<RESOURCE type="results">\n<INFO name="QUERY_STATUS" value="ERROR">{escape(message)}</INFO>\n'
+        '</RESOURCE>\n</VOTABLE>\n'
+    ).encode('utf-8')
+
+
+class TapHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so the pooled client reuses connections as it would against the archive
+    protocol_version = 'HTTP/1.1'
+    server_version = 'GaiaMapsLocalTAP/1.0'
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        params = parse_qs(self.rfile.read(length).decode('utf-8'))
+        return {k.upper(): v[0] for k, v in params.items()}
+
+    def _results(self, params):
+        fmt = params.get('FORMAT', 'votable').lower()
+        try:
+            fields, rows = run_query(params.get('QUERY', ''), self.server.fields, self.server.rows,
+                                     recenter=self.server.recenter)
+        except QueryError as e:
+            self._send(400, votable_error(str(e)), 'application/x-votable+xml')
+            return
+        if fmt == 'csv':
+            self._send(200, to_csv(fields, rows), 'text/csv')
+        else:
+            self._send(200, to_votable(fields, rows), 'application/x-votable+xml')
+
+    def do_POST(self):
+        params = self._form()
+        if self.path == '/tap/sync':
+            self._results(params)
+        elif self.path == '/tap/async':
+            # Jobs complete immediately; results are computed when fetched
+            job_id = self.server.new_job(params)
+            self._send(303, b'', 'text/plain', {'Location': f'/tap/async/{job_id}'})
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+    def do_GET(self):
+        match = re.fullmatch(r'/tap/async/(\d+)(/phase|/results/result)?', self.path)
+        params = self.server.jobs.get(match.group(1)) if match else None
+        if params is None:
+            self._send(404, b'Not found', 'text/plain')
+        elif match.group(2) == '/results/result':
+            self._results(params)
+            self.server.jobs.pop(match.group(1), None)
+        else:
+            self._send(200, b'COMPLETED', 'text/plain')
+
+
+class LocalTapServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fixture_path=FIXTURE_PATH, recenter=True, quiet=False):
+        super().__init__(address, TapHandler)
+        self.fields, self.rows = load_fixture(fixture_path)
+        self.recenter = recenter
+        self.quiet = quiet
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+
+    def new_job(self, params):
+        with self._jobs_lock:
+            job_id = str(next(self._job_ids))
+            self.jobs[job_id] = params
+        return job_id
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Gaia TAP service")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--fixture', default=FIXTURE_PATH, help='CSV of stars with Gaia column names')
+    parser.add_argument('--no-recenter', action='store_true', help='serve fixture positions as stored')
+    parser.add_argument('--quiet', action='store_true', help='do not log each request')
+    args = parser.parse_args()
+    server = LocalTapServer((args.host, args.port), args.fixture, recenter=not args.no_recenter, quiet=args.quiet)
+    print(f"Local TAP stand-in on http://{args.host}:{args.port}/tap ({len(server.rows)} fixture stars)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,6 @@ from astropy.time import Time
 from astropy.coordinates import AltAz, EarthLocation, ICRS, SkyCoord
 import astropy.units as u
 import numpy as np
-from astroquery.gaia import Gaia
 from astropy import coordinates as coords
 from fpdf import FPDF
 from datetime import datetime, timezone
@@ -14,9 +13,13 @@ import sys
 import os
 # No need to modify sys.path for backend-local import
 from generate_pdf import generate_pdf
+from derived import derive, derived_rows
+from enrichment import build_record, compute_record, enrichment_cache, source_key
+from archive import ArchiveUnavailable, make_archive_client
 from fastapi.responses import StreamingResponse
 import io
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from metrics import MetricsMiddleware, render_metrics, span
 
 # --- Helper functions for coordinate rotation ---
 import numpy as np  # ensure numpy available for helpers (already imported above but safe)
@@ -71,6 +74,9 @@ def radec_to_vector(ra_deg: float, dec_deg: float) -> np.ndarray:
     z = np.sin(dec_rad)
     return np.array([x, y, z])
 
+# One pooled archive client per worker, shared by all requests
+archive_client = make_archive_client()
+
 app = FastAPI(title="GaiaMaps API", description="API for querying Gaia stars above a location at a given time.")
 
 # Allow CORS for frontend
@@ -80,7 +86,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing"],
 )
+app.add_middleware(MetricsMiddleware, paths=("/get-stars", "/star-pdf"))
 
 from enum import Enum
 
@@ -112,6 +120,13 @@ class StarOut(BaseModel):
     az_diff: Optional[float]
     SOURCE_ID: Optional[Any]
     source_id: Optional[Any]
+    # Derived quantities (see derived.py); None where parallax or color is missing
+    distance_pc: Optional[float] = None
+    distance_ly: Optional[float] = None
+    abs_mag: Optional[float] = None
+    spectral_type: Optional[str] = None
+    galcen_x_kpc: Optional[float] = None
+    galcen_y_kpc: Optional[float] = None
     # Additional fields allowed
     class Config:
         extra = "allow"
@@ -120,6 +135,11 @@ class GetStarsResponse(BaseModel):
     center: Dict[str, float]
     stars: List[StarOut]
 
+@app.get("/metrics", response_class=PlainTextResponse, summary="Prometheus metrics")
+def metrics():
+    """Per-stage timing histograms, in-flight gauges and cache counters in Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
 @app.post("/get-stars", response_model=GetStarsResponse, summary="Get Gaia stars above a location at a given time")
 def get_stars(req: StarRequest):
     """Returns Gaia stars above the given lat/lon at the specified UTC datetime, ordered by angular distance."""
@@ -134,20 +154,21 @@ def get_stars(req: StarRequest):
             print(f"[ERROR] Invalid datetime format: {req.datetime_iso} ({e})", file=sys.stderr)
             raise HTTPException(status_code=400, detail="Invalid datetime format. Use ISO format (e.g. 2024-06-01T12:00:00Z)")
 
-        # Prepare time and location
-        utc_time = Time(selected_datetime)
-        observer_location = EarthLocation(lat=req.lat*u.deg, lon=req.lon*u.deg)
-        altaz_frame = AltAz(obstime=utc_time, location=observer_location)
+        with span("altaz"):
+            # Prepare time and location
+            utc_time = Time(selected_datetime)
+            observer_location = EarthLocation(lat=req.lat*u.deg, lon=req.lon*u.deg)
+            altaz_frame = AltAz(obstime=utc_time, location=observer_location)
 
-        observer_aux_location = EarthLocation(lat=(req.lat+1e-4)*u.deg, lon=req.lon*u.deg)
-        altaz_frame_aux = AltAz(obstime=utc_time, location=observer_aux_location)
+            observer_aux_location = EarthLocation(lat=(req.lat+1e-4)*u.deg, lon=req.lon*u.deg)
+            altaz_frame_aux = AltAz(obstime=utc_time, location=observer_aux_location)
 
-        # Compute zenith
-        zenith_icrs = SkyCoord(alt=90*u.deg, az=0*u.deg, frame=altaz_frame).transform_to(ICRS())
-        center = coords.SkyCoord(ra=zenith_icrs.ra, dec=zenith_icrs.dec, frame='icrs')
+            # Compute zenith
+            zenith_icrs = SkyCoord(alt=90*u.deg, az=0*u.deg, frame=altaz_frame).transform_to(ICRS())
+            center = coords.SkyCoord(ra=zenith_icrs.ra, dec=zenith_icrs.dec, frame='icrs')
 
-        zenith_icrs_aux = SkyCoord(alt=90*u.deg, az=0*u.deg, frame=altaz_frame_aux).transform_to(ICRS())
-        center_aux = coords.SkyCoord(ra=zenith_icrs_aux.ra, dec=zenith_icrs_aux.dec, frame='icrs')
+            zenith_icrs_aux = SkyCoord(alt=90*u.deg, az=0*u.deg, frame=altaz_frame_aux).transform_to(ICRS())
+            center_aux = coords.SkyCoord(ra=zenith_icrs_aux.ra, dec=zenith_icrs_aux.dec, frame='icrs')
 
         # --- Build query based on settings ---
         center_ra = center.ra.deg
@@ -199,57 +220,72 @@ def get_stars(req: StarRequest):
         WHERE {where_sql}
         ORDER BY ang_dist ASC
         """
-        job = Gaia.launch_job(query)
-        results = job.get_results()
-
-        # --- Build rotation matrix from ICRS to local ENU (east-north-up) ---
-        A_vec = radec_to_vector(center_ra, center_dec)
-        B_vec = radec_to_vector(center_aux.ra.deg, center_aux.dec.deg)
-
-        A_prime = np.array([0.0, 0.0, 1.0])  # local zenith (Up) in ENU
-        # North reference vector at same angular separation from zenith
-        delta_rad = np.arccos(np.clip(np.dot(A_vec, B_vec), -1.0, 1.0))
-        B_prime = np.array([0.0, np.sin(delta_rad), np.cos(delta_rad)])  # aligns with ENU north
-
-        R_icrs_to_enu = rotation_from_two_vectors(A_vec, B_vec, A_prime, B_prime)
-
-        stars = []
-        for row in results:
-            # --- Transform star to local ENU ---
-            v_icrs = radec_to_vector(row['ra'], row['dec'])
-            v_enu = R_icrs_to_enu @ v_icrs  # (east, north, up)
-
-            # Angular separation from zenith
-            z_comp = np.clip(v_enu[2], -1.0, 1.0)
-            theta = np.arccos(z_comp)  # radians, small for near-zenith stars
-
-            if theta < 1e-8:
-                d_east_deg = 0.0
-                d_north_deg = 0.0
-            else:
-                horiz_vec = v_enu[:2]  # east, north components
-                horiz_norm = np.linalg.norm(horiz_vec)
-                if horiz_norm < 1e-12:
+        results = archive_client.query(query, max_rows=limit_value)
+
+        with span("projection"):
+            # --- Build rotation matrix from ICRS to local ENU (east-north-up) ---
+            A_vec = radec_to_vector(center_ra, center_dec)
+            B_vec = radec_to_vector(center_aux.ra.deg, center_aux.dec.deg)
+
+            A_prime = np.array([0.0, 0.0, 1.0])  # local zenith (Up) in ENU
+            # North reference vector at same angular separation from zenith
+            delta_rad = np.arccos(np.clip(np.dot(A_vec, B_vec), -1.0, 1.0))
+            B_prime = np.array([0.0, np.sin(delta_rad), np.cos(delta_rad)])  # aligns with ENU north
+
+            R_icrs_to_enu = rotation_from_two_vectors(A_vec, B_vec, A_prime, B_prime)
+
+            stars = []
+            for row in results:
+                # --- Transform star to local ENU ---
+                v_icrs = radec_to_vector(row['ra'], row['dec'])
+                v_enu = R_icrs_to_enu @ v_icrs  # (east, north, up)
+
+                # Angular separation from zenith
+                z_comp = np.clip(v_enu[2], -1.0, 1.0)
+                theta = np.arccos(z_comp)  # radians, small for near-zenith stars
+
+                if theta < 1e-8:
                     d_east_deg = 0.0
                     d_north_deg = 0.0
                 else:
-                    unit_horiz = horiz_vec / horiz_norm
-                    # Scale unit horizontal direction by angular distance (deg)
-                    d_deg = np.degrees(theta)
-                    # Convert east angular offset to degrees of longitude at current latitude
-                    cos_lat = np.cos(np.deg2rad(req.lat)) if abs(req.lat) < 89.999 else 1e-6
-                    d_east_deg = (d_deg * unit_horiz[0]) / cos_lat
-                    d_north_deg = d_deg * unit_horiz[1]
-
-            star = {k: (row[k].item() if hasattr(row[k], 'item') else row[k]) for k in row.keys()}
-            star['az_diff'] = d_east_deg   # east (+) / west (-)
-            star['alt_diff'] = d_north_deg # north (+) / south (-)
-
-            if 'SOURCE_ID' not in star:
-                star['SOURCE_ID'] = None
-            if 'source_id' not in star:
-                star['source_id'] = None
-            stars.append(star)
+                    horiz_vec = v_enu[:2]  # east, north components
+                    horiz_norm = np.linalg.norm(horiz_vec)
+                    if horiz_norm < 1e-12:
+                        d_east_deg = 0.0
+                        d_north_deg = 0.0
+                    else:
+                        unit_horiz = horiz_vec / horiz_norm
+                        # Scale unit horizontal direction by angular distance (deg)
+                        d_deg = np.degrees(theta)
+                        # Convert east angular offset to degrees of longitude at current latitude
+                        cos_lat = np.cos(np.deg2rad(req.lat)) if abs(req.lat) < 89.999 else 1e-6
+                        d_east_deg = (d_deg * unit_horiz[0]) / cos_lat
+                        d_north_deg = d_deg * unit_horiz[1]
+
+                star = {k: (row[k].item() if hasattr(row[k], 'item') else row[k]) for k in row.keys()}
+                star['az_diff'] = d_east_deg   # east (+) / west (-)
+                star['alt_diff'] = d_north_deg # north (+) / south (-)
+
+                if 'SOURCE_ID' not in star:
+                    star['SOURCE_ID'] = None
+                # Always a string, whichever column name the archive used, so all
+                # 64 bits survive JSON numbers in the browser and match the cache key
+                source_id = star.get('source_id')
+                if source_id is None:
+                    source_id = star['SOURCE_ID']
+                star['source_id'] = str(source_id) if source_id is not None else None
+                stars.append(star)
+
+        with span("derived"):
+            # Distance, abs. magnitude, spectral type and galactocentric x/y for all stars in one pass
+            derived = derive(results['ra'], results['dec'], results['parallax'],
+                             results['phot_g_mean_mag'], results['bp_rp'])
+            for star, extra in zip(stars, derived_rows(derived)):
+                star.update(extra)
+
+        with span("enrichment_store"):
+            # Certificate fields for /star-pdf, keyed by source_id
+            enrichment_cache.put_many((source_key(star), build_record(star)) for star in stars)
 
         print(f"[LOG] Query returned {len(stars)} stars", file=sys.stderr)
         return {"center": {"ra": center_ra, "dec": center_dec}, "stars": stars}
@@ -257,6 +293,12 @@ def get_stars(req: StarRequest):
     except HTTPException as he:
         print(f"[ERROR] HTTPException: {he.detail}", file=sys.stderr)
         raise
+    except ArchiveUnavailable as e:
+        print(f"[ERROR] Gaia archive unavailable: {str(e)}", file=sys.stderr)
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Gaia archive is temporarily unavailable. Please try again later."}
+        )
     except Exception as e:
         # User-friendly error for Gaia archive maintenance or VOTABLE errors
         if "VOTABLE" in str(e) or "maintenance" in str(e).lower():
@@ -278,36 +320,26 @@ def star_pdf(req: PDFRequest):
         "This star, likely never noticed by any human before, "
         "shone directly above you on your special day..."
     )
-    # --- Robust field mapping ---
-    # Distance in light years from parallax (mas)
-    parallax = star_info.get('parallax')
-    if parallax is None:
-        parallax = star_info.get('parallax_mas')
-    try:
-        parallax_val = float(parallax)
-    except (TypeError, ValueError):
-        parallax_val = None
-    if parallax_val and parallax_val > 0:
-        distance_pc = 1000.0 / parallax_val
-        distance_ly = distance_pc * 3.26156
-        star_info['distance_ly'] = round(distance_ly)
-        print(f"[PDF] parallax: {parallax_val} mas, distance: {distance_pc:.2f} pc, {distance_ly:.2f} ly")
-    # Color index
-    if 'color_index' not in star_info and 'bp_rp' in star_info:
-        star_info['color_index'] = star_info['bp_rp']
-    # Absolute magnitude from Gmag and parallax
-    phot_g = star_info.get('phot_g_mean_mag')
-    if phot_g is not None and parallax and isinstance(parallax, (int, float)) and parallax > 0:
-        abs_mag = phot_g + 5 * (np.log10(parallax) + 1) - 10
-        star_info['abs_mag'] = round(abs_mag, 2)
-    # Proper motion
-    pmra = star_info.get('pmra')
-    pmdec = star_info.get('pmdec')
-    if pmra is not None and pmdec is not None:
-        pm_total = (pmra**2 + pmdec**2) ** 0.5
-        star_info['proper_motion'] = f"{pm_total:.1f} mas/yr"
+    # --- Derived fields: server-side cache first, payload as fallback ---
+    with span("pdf_enrich"):
+        key = source_key(star_info)
+        record = enrichment_cache.get(key)
+        if record is None:
+            # Distance in light years from parallax (mas)
+            parallax = star_info.get('parallax')
+            if parallax is None:
+                parallax = star_info.get('parallax_mas')
+            source = {**star_info, 'parallax': parallax}
+            # Color index
+            if source.get('bp_rp') is None:
+                source['bp_rp'] = star_info.get('color_index')
+            # Not stored: only stars served by /get-stars are trusted into the cache
+            record = compute_record(source)
+        star_info.update(record)
+        print(f"[PDF] source_id: {key}, distance: {record.get('distance_ly')} ly, abs. mag: {record.get('abs_mag')}")
     output = io.BytesIO()
-    generate_pdf(star_info, output_path=output)
+    with span("pdf_render"):
+        generate_pdf(star_info, output_path=output)
     output.seek(0)
     return StreamingResponse(output, media_type="application/pdf", headers={
         "Content-Disposition": "attachment; filename=star_report.pdf"
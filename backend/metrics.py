@@ -0,0 +1,249 @@
+"""
+metrics.py
+
+Lightweight per-stage timing instrumentation for the GaiaMaps API.
+
+Stages are timed with the ``span`` context manager and aggregated into
+Prometheus-style histograms, exposed as plain text on ``/metrics``. When
+``GAIAMAPS_SERVER_TIMING=1`` the spans recorded during a request are also
+returned in a ``Server-Timing`` response header.
+
+Environment:
+- GAIAMAPS_METRICS         # "0" disables all instrumentation (default "1")
+- GAIAMAPS_SERVER_TIMING   # "1" adds the Server-Timing header (default "0")
+"""
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+METRICS_ENABLED = os.environ.get("GAIAMAPS_METRICS", "1") != "0"
+SERVER_TIMING_ENABLED = METRICS_ENABLED and os.environ.get("GAIAMAPS_SERVER_TIMING", "0") == "1"
+
+# Seconds; tuned for stages ranging from sub-millisecond loops to slow archive jobs
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Spans recorded during the current request (None outside a request)
+_request_spans: ContextVar = ContextVar("gaiamaps_request_spans", default=None)
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    body = ",".join(f'{k}="{str(v)}"' for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+# --- Metric types ---
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount=1.0):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def dec(self, *labelvalues, amount=1.0):
+        self.inc(*labelvalues, amount=-amount)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # labelvalues -> [per-bucket counts, sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = [[0] * len(self.buckets), 0.0, 0]
+                self._values[labelvalues] = entry
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, labelvalues, ("le", _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+# --- Registry ---
+STAGE_SECONDS = Histogram(
+    "gaiamaps_stage_duration_seconds",
+    "Time spent in each request stage.",
+    labelnames=("stage",),
+)
+REQUEST_SECONDS = Histogram(
+    "gaiamaps_request_duration_seconds",
+    "End-to-end request latency by route.",
+    labelnames=("path",),
+)
+IN_FLIGHT = Gauge(
+    "gaiamaps_requests_in_flight",
+    "Requests currently being served by route.",
+    labelnames=("path",),
+)
+CACHE_REQUESTS = Counter(
+    "gaiamaps_cache_requests_total",
+    "Cache lookups by cache name and result (hit/miss).",
+    labelnames=("cache", "result"),
+)
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, IN_FLIGHT, CACHE_REQUESTS]
+
+
+def render_metrics():
+    """Return every registered metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def record_cache(cache, hit):
+    """Count a lookup against *cache* as a hit or a miss."""
+    if METRICS_ENABLED:
+        CACHE_REQUESTS.inc(cache, "hit" if hit else "miss")
+
+
+# --- Spans ---
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        STAGE_SECONDS.observe(elapsed, self.stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((self.stage, elapsed))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(stage):
+    """Time the enclosed block as *stage*; a shared no-op when metrics are disabled."""
+    if not METRICS_ENABLED:
+        return _NULL_SPAN
+    return _Span(stage)
+
+
+def _server_timing_header(spans):
+    # Repeated stages (e.g. two overlays) are summed into one entry
+    totals = {}
+    for stage, elapsed in spans:
+        totals[stage] = totals.get(stage, 0.0) + elapsed
+    return ", ".join(f"{stage};dur={elapsed * 1000:.1f}" for stage, elapsed in totals.items())
+
+
+# --- ASGI middleware ---
+class MetricsMiddleware:
+    """Track in-flight requests and latency per route, and emit Server-Timing if enabled."""
+
+    def __init__(self, app, paths=()):
+        self.app = app
+        # Only known routes get their own label to keep cardinality bounded
+        self.paths = frozenset(paths)
+
+    async def __call__(self, scope, receive, send):
+        if not METRICS_ENABLED or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        path = scope.get("path", "")
+        label = path if path in self.paths else "other"
+        spans = []
+        token = _request_spans.set(spans)
+
+        async def send_wrapper(message):
+            if SERVER_TIMING_ENABLED and message["type"] == "http.response.start" and spans:
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", _server_timing_header(spans).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        IN_FLIGHT.inc(label)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUEST_SECONDS.observe(time.perf_counter() - start, label)
+            IN_FLIGHT.dec(label)
+            _request_spans.reset(token)
@@ -0,0 +1,62 @@
+"""Smoke tests: TapArchiveClient against the local TAP stand-in."""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("astropy")
+pytest.importorskip("requests")
+
+from archive import ArchiveError, TapArchiveClient
+from local_tap import LocalTapServer
+
+QUERY = """
+SELECT TOP {top} *, DISTANCE(POINT('ICRS', ra, dec), POINT('ICRS', 123.4, 45.6)) AS ang_dist
+FROM gaiadr3.gaia_source
+WHERE 1=CONTAINS(POINT('ICRS', ra, dec), CIRCLE('ICRS', 123.4, 45.6, 2.0)) AND parallax IS NOT NULL
+ORDER BY ang_dist ASC
+"""
+
+
+@pytest.fixture(scope="module")
+def tap_server():
+    server = LocalTapServer(("127.0.0.1", 0), quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def tap_url(tap_server):
+    return f"http://127.0.0.1:{tap_server.server_address[1]}/tap"
+
+
+@pytest.mark.parametrize("fmt", ["votable", "csv"])
+@pytest.mark.parametrize("max_rows", [50, 5000])  # /sync and /async
+def test_query_returns_sorted_rows(tap_url, fmt, max_rows):
+    client = TapArchiveClient(base_url=tap_url, fmt=fmt, retries=0)
+    results = client.query(QUERY.format(top=max_rows), max_rows=max_rows)
+    assert 0 < len(results) <= max_rows
+    assert {"SOURCE_ID", "ra", "dec", "parallax", "phot_g_mean_mag", "bp_rp", "ang_dist"} <= set(results.colnames)
+    ang_dist = list(results["ang_dist"])
+    assert ang_dist == sorted(ang_dist) and ang_dist[-1] <= 2.0
+    assert int(results["SOURCE_ID"][0]) > 2**53  # 64-bit ids survive parsing
+
+
+@pytest.mark.parametrize("fmt", ["votable", "csv"])
+def test_query_error_raises(tap_url, fmt):
+    client = TapArchiveClient(base_url=tap_url, fmt=fmt, retries=0)
+    with pytest.raises(ArchiveError):
+        client.query("SELECT 1")
+
+
+def test_missing_async_job_fails_fast(tap_server, tap_url, monkeypatch):
+    # Point the client at a job id the server does not know
+    monkeypatch.setattr(tap_server, "new_job", lambda params: "999999")
+    client = TapArchiveClient(base_url=tap_url, retries=0, async_timeout=30)
+    start = time.monotonic()
+    with pytest.raises(ArchiveError, match="HTTP 404"):
+        client.query(QUERY.format(top=5000), max_rows=5000)
+    assert time.monotonic() - start < 5
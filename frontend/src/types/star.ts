@@ -7,6 +7,12 @@ export interface StarData {
   bp_rp?: number;
   alt_diff?: number;
   az_diff?: number;
+  distance_pc?: number | null;
+  distance_ly?: number | null;
+  abs_mag?: number | null;
+  spectral_type?: string | null;
+  galcen_x_kpc?: number | null;
+  galcen_y_kpc?: number | null;
   base_lat?: number;
   base_lng?: number;
   [key: string]: any; // Allow additional Gaia fields